@@ -1,9 +1,30 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import fnmatch
+import os
+import re
+import shutil
+import stat
+import string
+import struct
 import sys
+import tarfile
+import tempfile
+import zipfile
 
-from sosdisk import SOSDisk
+from sosdisk import FileAttributes, FileType, SOSDisk, StorageType, block_extents, dos_to_phys_sect, half_block_to_phys_sect, interleave_tables, permute_sectors, sector_permutation
+
+
+def image_format(image_fn, fmt = None):
+    if fmt is not None:
+        return fmt
+    if image_fn.endswith('.do') or image_fn.endswith('.dsk'):
+        return 'do'
+    if image_fn.endswith('.po'):
+        return 'po'
+    return None
 
 
 def cmd_ls(args, disk):
@@ -14,102 +35,527 @@ def cmd_mkfs(args, disk):
     print('XXX mkfs')
 
 
+# Extra field header ID used in zip archives to record the ProDOS file
+# type, aux type and access byte of each member.
+zip_prodos_extra_id = 0x5053  # 'SP'
+
+zip_min_date_time = (1980, 1, 1, 0, 0, 0)
+
+
+# ProDOS names must start with a letter.  Checking that every
+# component does keeps names such as '.' and '..' from a crafted image
+# out of the paths files are extracted to.
+def valid_path(path):
+    return all(name[:1] in string.ascii_lowercase for name in path.split('/'))
+
+
+# Returns a list of (path, entry) for the files selected by the
+# command line, and a list of the names that don't exist.  A directory
+# name selects the files in it, and with -r those in its
+# subdirectories too.
+def selected_files(args, disk):
+    files = { }
+    unmatched = []
+    disk.prefetch(recursive = args.recursive)
+    for name in [name.lower().strip('/') for name in args.filename] or ['']:
+        if name == '':
+            files.update(disk.files(path = '', recursive = args.recursive))
+            continue
+        try:
+            entry = disk.lookup(name)
+        except FileNotFoundError:
+            unmatched.append(name)
+            continue
+        if entry.storage_type == StorageType.subdirectory:
+            files.update(entry.subdir.files(path = name + '/', recursive = args.recursive))
+        else:
+            files[name] = entry
+    return list(files.items()), unmatched
+
+
+def extract_to_dir(files):
+    root = os.path.realpath('.')
+    for path, sf in files:
+        if os.path.commonpath([root, os.path.realpath(path)]) != root:
+            raise ValueError('%s: outside the current directory' % path)
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok = True)
+        with open(path, 'wb') as f:
+            for offset, data in sf.storage.iter_chunks(len(sf)):
+                f.write(data)
+        if sf.creation_timestamp is not None:
+            mtime = sf.creation_timestamp.timestamp()
+            os.utime(path, (mtime, mtime))
+
+
+def extract_to_tar(files, tar_fn):
+    if tar_fn == '-':
+        tar = tarfile.open(fileobj = sys.stdout.buffer, mode = 'w|', format = tarfile.PAX_FORMAT)
+    else:
+        tar = tarfile.open(tar_fn, mode = 'w', format = tarfile.PAX_FORMAT)
+    with tar:
+        for path, sf in files:
+            info = tarfile.TarInfo(path)
+            info.size = len(sf)
+            info.mode = 0o644 if sf.access & FileAttributes.write_enable else 0o444
+            if sf.creation_timestamp is not None:
+                info.mtime = int(sf.creation_timestamp.timestamp())
+            # stored as user extended attributes, which GNU tar and
+            # bsdtar restore with --xattrs and otherwise ignore quietly
+            info.pax_headers = { 'SCHILY.xattr.user.prodos.file_type': '%02x' % sf.file_type,
+                                 'SCHILY.xattr.user.prodos.aux_type':  '%04x' % sf.aux_type,
+                                 'SCHILY.xattr.user.prodos.access':    '%02x' % sf.access }
+            with sf.open() as f:
+                tar.addfile(info, f)
+
+
+def extract_to_zip(files, zip_fn):
+    with zipfile.ZipFile(sys.stdout.buffer if zip_fn == '-' else zip_fn,
+                         mode = 'w',
+                         compression = zipfile.ZIP_DEFLATED) as zf:
+        for path, sf in files:
+            date_time = zip_min_date_time
+            if sf.creation_timestamp is not None:
+                date_time = max(date_time, sf.creation_timestamp.timetuple()[:6])
+            info = zipfile.ZipInfo(path, date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            mode = 0o644 if sf.access & FileAttributes.write_enable else 0o444
+            info.external_attr = (stat.S_IFREG | mode) << 16
+            info.extra = struct.pack('<HHBHB', zip_prodos_extra_id, 4,
+                                     sf.file_type, sf.aux_type, sf.access)
+            with zf.open(info, mode = 'w') as f:
+                for offset, data in sf.storage.iter_chunks(len(sf)):
+                    f.write(data)
+
+
 def cmd_extract(args, disk):
-    for sf in disk.files(path = '', recursive = True):
-        name = sf.get_name()
-        #print(name)
-        #print(len(name))
-        length = len(sf)
-        data = sf.read(length)
-        #print(len(data))
-        with open(name, 'wb') as f:
-            f.write(data)
-        break # XXX for debug, only extract first file
-
-
-parser = argparse.ArgumentParser()
-
-fmt_group = parser.add_mutually_exclusive_group()
-
-fmt_group.add_argument('--do',
-                       dest = 'format',
-                       action = 'store_const',
-                       const = 'do',
-                       help = "image in DOS sector order")
-
-fmt_group.add_argument('--po',
-                       dest = 'format',
-                       action = 'store_const',
-                       const = 'po',
-                       help = "image in SOS/ProDOS sector order")
-
-parser.add_argument('image',
-                    type = str,
-                    help = "SOS/ProDOS disk image")
-
-subparsers = parser.add_subparsers(title = 'commands',
-                                   dest = 'cmd')
-
-ls_parser = subparsers.add_parser('ls',
-                                  help = 'list files')
-ls_parser.set_defaults(cmd_fn = cmd_ls)
-
-ls_parser.add_argument('-r', '--recursive',
-                       action = 'store_true',
-                       help = 'recursively list subdirectories')
-
-ls_parser.add_argument('-l', '--long',
-                       action = 'store_true',
-                       help = 'list file attributes')
-
-mkfs_parser = subparsers.add_parser('mkfs',
-                                    help = 'make new filesystem')
-mkfs_parser.set_defaults(cmd_fn = cmd_mkfs)
-
-mkfs_parser.add_argument('--size',
-                         type = int,
-                         default = 280,
-                         help = 'filesystem size in blocks')
-
-extract_parser = subparsers.add_parser('x',
-                                       help = 'extract file(s)')
-extract_parser.set_defaults(cmd_fn = cmd_extract)
-
-extract_parser.add_argument('-r', '--recursive',
-                       action = 'store_true',
-                       help = 'recursively extract subdirectory content')
-
-extract_parser.add_argument('filename',
-                            type = str,
-                            nargs = '+',
-                            help = 'filename(s) to extract',
-)
-
-args = parser.parse_args()
-#print(args)
-
-if args.format is not None:
-    fmt = args.format
-elif args.image.endswith('.do') or args.image.endswith('.dsk'):
-    fmt = 'do'
-elif args.image.endswith('.po'):
-    fmt = 'po'
-else:
-    print('must specify image file format', file = sys.stderr)
-    sys.exit(2)
-
-file_mode = { 'mkfs': 'w',
-              'ls': 'r',
-              'x': 'r' } [args.cmd] + 'b'
-
-image = open(args.image, file_mode)
-
-if args.cmd == 'mkfs':
-    disk = SOSDisk(image, fmt, new = True, volume_block_count = args.size)
-else:
-    disk = SOSDisk(image, fmt)
-
-args.cmd_fn(args, disk)
-
-disk.close()
-    
+    files, unmatched = selected_files(args, disk)
+    for name in unmatched:
+        print('%s: not found' % name, file = sys.stderr)
+    invalid = [path for path, sf in files if not valid_path(path)]
+    for path in invalid:
+        print('%s: invalid file name' % path, file = sys.stderr)
+    if unmatched or invalid:
+        return 1
+    if args.to_tar is not None:
+        extract_to_tar(files, args.to_tar)
+    elif args.to_zip is not None:
+        extract_to_zip(files, args.to_zip)
+    else:
+        try:
+            extract_to_dir(files)
+        except ValueError as e:
+            print(e, file = sys.stderr)
+            return 2
+
+
+# Returns a list of (path, blocks, extents) for the volume directory and
+# every subdirectory and file, sorted by path.
+def fragmentation(disk):
+    extents = disk.volume_directory.extents()
+    report = [('/', sum(count for first, count in extents), len(extents))]
+    # finish the walk first, so every subdirectory is attached
+    for path, entry in list(disk.walk()):
+        if entry.storage_type == StorageType.subdirectory:
+            path += '/'
+            extents = entry.subdir.extents()
+        else:
+            extents = entry.storage.extents()
+        report.append((path, sum(count for first, count in extents), len(extents)))
+    return sorted(report)
+
+
+def fragmentation_summary(disk, report):
+    fragmented = sum(1 for path, blocks, extents in report if extents > 1)
+    free_runs = disk.allocation_bitmap.free_runs()
+    return ('%d files and directories, %d fragmented, %d extents\n'
+            '%d blocks free, largest free run %d blocks' %
+            (len(report), fragmented, sum(extents for path, blocks, extents in report),
+             sum(count for first, count in free_runs),
+             max((count for first, count in free_runs), default = 0)))
+
+
+def cmd_frag(args, disk):
+    report = fragmentation(disk)
+    print('extents  blocks  path')
+    for path, blocks, extents in report:
+        if extents > 1 or not args.fragmented:
+            print('%7d  %6d  %s' % (extents, blocks, path))
+    print(fragmentation_summary(disk, report))
+
+
+# The image is opened read-only; the defragmented image is written to
+# a temporary file next to the output and renamed over it, so a
+# failure part way through leaves the original intact.
+def cmd_defrag(args, disk):
+    out_fn = args.output if args.output is not None else args.image
+    print('before:')
+    print(fragmentation_summary(disk, fragmentation(disk)))
+    unowned = disk.defragment(free_unowned = args.free_unowned)
+    # written below rather than by close()
+    disk.dirty = False
+    if unowned:
+        print('%s %d block(s) marked in use but not owned by any file: %s' %
+              ('freed' if args.free_unowned else 'kept in place', len(unowned),
+               ', '.join(str(first) if count == 1 else '%d-%d' % (first, first + count - 1)
+                         for first, count in block_extents(unowned))))
+    try:
+        fd, tmp_fn = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(out_fn)),
+                                      prefix = '.' + os.path.basename(out_fn) + '.')
+    except OSError as e:
+        print('%s: %s' % (out_fn, e), file = sys.stderr)
+        return 2
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            disk.write(f)
+        shutil.copymode(args.image, tmp_fn)
+        os.replace(tmp_fn, out_fn)
+    except BaseException:
+        os.unlink(tmp_fn)
+        raise
+    print('after:')
+    print(fragmentation_summary(disk, fragmentation(disk)))
+
+
+def parse_file_type(s):
+    try:
+        return FileType[s.lower()]
+    except KeyError:
+        pass
+    if s.startswith('$'):
+        s = '0x' + s[1:]
+    try:
+        return int(s, 0)
+    except ValueError:
+        raise argparse.ArgumentTypeError('unknown file type %s' % s)
+
+
+# Runs in a worker process, so it opens the image itself rather than
+# being handed a SOSDisk.  Returns a list of (path, offset) hits, or
+# an error message string if the image can't be searched.
+def grep_image(image_fn, fmt, pattern, ignore_case, file_types, path_pattern):
+    regex = re.compile(re.escape(pattern), re.IGNORECASE if ignore_case else 0)
+    hits = []
+    try:
+        with open(image_fn, 'rb') as image:
+            disk = SOSDisk(image, fmt)
+            disk.prefetch()
+            for path, sf in disk.files(path = '', recursive = True):
+                if file_types and sf.file_type not in file_types:
+                    continue
+                if path_pattern is not None and not fnmatch.fnmatchcase(path, path_pattern):
+                    continue
+                # carry the tail of each chunk over to the next one, so
+                # that matches spanning a block boundary are found
+                tail = b''
+                match_end = 0
+                for offset, data in sf.storage.iter_chunks(len(sf)):
+                    base = offset - len(tail)
+                    buf = tail + data
+                    for m in regex.finditer(buf):
+                        if base + m.start() >= match_end:
+                            hits.append((path, base + m.start()))
+                            match_end = base + m.end()
+                    tail = buf[max(0, len(buf) - (len(pattern) - 1)):]
+    except (Exception, SystemExit) as e:
+        return '%s: %s' % (image_fn, e)
+    return hits
+
+
+def cmd_grep(args):
+    if args.hex:
+        try:
+            pattern = bytes.fromhex(args.pattern)
+        except ValueError:
+            print('invalid hex pattern %s' % args.pattern, file = sys.stderr)
+            return 2
+    else:
+        try:
+            pattern = args.pattern.encode('ascii')
+        except UnicodeEncodeError:
+            print('pattern %s is not ASCII, use -x for other bytes' % args.pattern, file = sys.stderr)
+            return 2
+    if not pattern:
+        print('empty pattern', file = sys.stderr)
+        return 2
+    file_types = set(args.type or [])
+    # paths are matched without the leading '/' that is printed
+    path_pattern = args.path.lower().lstrip('/') if args.path is not None else None
+
+    image_fns = [args.image] + args.images
+    status = 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers = args.jobs) as executor:
+        futures = []
+        for fn in image_fns:
+            fmt = image_format(fn, args.format)
+            if fmt is None:
+                print('%s: must specify image file format' % fn, file = sys.stderr)
+                status = 2
+                continue
+            futures.append((fn, executor.submit(grep_image, fn, fmt, pattern,
+                                                args.ignore_case, file_types,
+                                                path_pattern)))
+        for fn, future in futures:
+            result = future.result()
+            if isinstance(result, str):
+                print(result, file = sys.stderr)
+                status = 2
+                continue
+            for path, offset in result:
+                print('%s:/%s:%d' % (fn, path, offset))
+            if result and status == 1:
+                status = 0
+    return status
+
+
+# 5.25" floppy images have 35 tracks, or 40 on some drives
+floppy_track_counts = (35, 40)
+
+
+def order_extension(order):
+    if interleave_tables[order] is dos_to_phys_sect:
+        return '.do'
+    if interleave_tables[order] is half_block_to_phys_sect:
+        return '.po'
+    return '.' + order
+
+
+# Rewrites raw 16-sector floppy images from one sector order to
+# another.  The images aren't parsed as SOS/ProDOS, so DOS 3.3 and
+# other disks can be converted too.
+def cmd_convert(args):
+    image_fns = [args.image] + args.images
+    if args.output is not None and len(image_fns) != 1:
+        print('--output can only be used with a single image', file = sys.stderr)
+        return 2
+    dest_interleave = interleave_tables[args.to]
+    permutations = { }
+    status = 0
+    for fn in image_fns:
+        fmt = image_format(fn, args.src_order or args.format)
+        if fmt is None:
+            print('%s: must specify image file format' % fn, file = sys.stderr)
+            status = 2
+            continue
+        if args.output is not None:
+            out_fn = args.output
+        else:
+            out_fn = os.path.splitext(fn)[0] + order_extension(args.to)
+        if out_fn == fn:
+            if interleave_tables[fmt] is not dest_interleave:
+                print('%s: output would overwrite input' % fn, file = sys.stderr)
+                status = 2
+            continue
+        if os.path.exists(out_fn) and not args.force:
+            print('%s: %s already exists' % (fn, out_fn), file = sys.stderr)
+            status = 2
+            continue
+        try:
+            with open(fn, 'rb') as f:
+                data = f.read()
+            track_count = len(data) // (16 * 256)
+            if len(data) % (16 * 256) or track_count not in floppy_track_counts:
+                print('%s: not a 16-sector floppy image' % fn, file = sys.stderr)
+                status = 2
+                continue
+            key = (fmt, track_count)
+            if key not in permutations:
+                permutations[key] = sector_permutation(interleave_tables[fmt], dest_interleave, track_count)
+            with open(out_fn, 'wb') as f:
+                f.write(permute_sectors(data, permutations[key]))
+        except OSError as e:
+            print('%s: %s' % (fn, e), file = sys.stderr)
+            status = 2
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    fmt_group = parser.add_mutually_exclusive_group()
+
+    fmt_group.add_argument('--do',
+                           dest = 'format',
+                           action = 'store_const',
+                           const = 'do',
+                           help = "image in DOS sector order")
+
+    fmt_group.add_argument('--po',
+                           dest = 'format',
+                           action = 'store_const',
+                           const = 'po',
+                           help = "image in SOS/ProDOS sector order")
+
+    parser.add_argument('image',
+                        type = str,
+                        help = "SOS/ProDOS disk image")
+
+    subparsers = parser.add_subparsers(title = 'commands',
+                                       dest = 'cmd')
+
+    ls_parser = subparsers.add_parser('ls',
+                                      help = 'list files')
+    ls_parser.set_defaults(cmd_fn = cmd_ls)
+
+    ls_parser.add_argument('-r', '--recursive',
+                           action = 'store_true',
+                           help = 'recursively list subdirectories')
+
+    ls_parser.add_argument('-l', '--long',
+                           action = 'store_true',
+                           help = 'list file attributes')
+
+    mkfs_parser = subparsers.add_parser('mkfs',
+                                        help = 'make new filesystem')
+    mkfs_parser.set_defaults(cmd_fn = cmd_mkfs)
+
+    mkfs_parser.add_argument('--size',
+                             type = int,
+                             default = 280,
+                             help = 'filesystem size in blocks')
+
+    extract_parser = subparsers.add_parser('x',
+                                           help = 'extract file(s)')
+    extract_parser.set_defaults(cmd_fn = cmd_extract)
+
+    extract_parser.add_argument('-r', '--recursive',
+                           action = 'store_true',
+                           help = 'recursively extract subdirectory content')
+
+    extract_parser.add_argument('filename',
+                                type = str,
+                                nargs = '*',
+                                help = 'filename(s) or directories to extract (default: volume directory)',
+    )
+
+    extract_dest_group = extract_parser.add_mutually_exclusive_group()
+
+    extract_dest_group.add_argument('--to-tar',
+                                    metavar = 'FILE',
+                                    type = str,
+                                    help = 'write files to a pax tar archive instead, - for stdout')
+
+    extract_dest_group.add_argument('--to-zip',
+                                    metavar = 'FILE',
+                                    type = str,
+                                    help = 'write files to a zip archive instead, - for stdout')
+
+    frag_parser = subparsers.add_parser('frag',
+                                        help = 'report file fragmentation and free space')
+    frag_parser.set_defaults(cmd_fn = cmd_frag)
+
+    frag_parser.add_argument('-f', '--fragmented',
+                             action = 'store_true',
+                             help = 'only list files and directories with more than one extent')
+
+    defrag_parser = subparsers.add_parser('defrag',
+                                          help = 'rewrite the image with every file and directory contiguous')
+    defrag_parser.set_defaults(cmd_fn = cmd_defrag)
+
+    defrag_parser.add_argument('-o', '--output',
+                               type = str,
+                               help = 'write the defragmented image here (default: replace the image)')
+
+    defrag_parser.add_argument('--free-unowned',
+                               action = 'store_true',
+                               help = 'free and zero blocks marked in use that no file owns, rather than keeping them in place')
+
+    # grep and convert open their images themselves, possibly several
+    # at once, so their cmd_fn takes no disk
+    grep_parser = subparsers.add_parser('grep',
+                                        help = 'search file contents')
+    grep_parser.set_defaults(cmd_fn = cmd_grep,
+                             multi_image = True)
+
+    grep_parser.add_argument('-i', '--ignore-case',
+                             action = 'store_true',
+                             help = 'ignore ASCII case distinctions')
+
+    grep_parser.add_argument('-x', '--hex',
+                             action = 'store_true',
+                             help = 'pattern is a hex byte string')
+
+    grep_parser.add_argument('-t', '--type',
+                             type = parse_file_type,
+                             action = 'append',
+                             help = 'only search files of this type (name or $xx), may be repeated')
+
+    grep_parser.add_argument('-p', '--path',
+                             type = str,
+                             help = 'only search files whose path matches this glob pattern')
+
+    grep_parser.add_argument('-j', '--jobs',
+                             type = int,
+                             help = 'number of images to search in parallel (default: CPU count)')
+
+    grep_parser.add_argument('pattern',
+                             type = str,
+                             help = 'string or byte signature to search for')
+
+    grep_parser.add_argument('images',
+                             type = str,
+                             nargs = '*',
+                             help = 'additional images to search')
+
+    convert_parser = subparsers.add_parser('convert',
+                                           help = 'convert image(s) to another sector order')
+    convert_parser.set_defaults(cmd_fn = cmd_convert,
+                                multi_image = True)
+
+    convert_parser.add_argument('--from',
+                                dest = 'src_order',
+                                choices = sorted(interleave_tables),
+                                help = 'sector order to convert from (default: --do/--po or image extension)')
+
+    convert_parser.add_argument('--to',
+                                choices = sorted(interleave_tables),
+                                default = 'po',
+                                help = 'sector order to convert to (default: po)')
+
+    convert_parser.add_argument('-o', '--output',
+                                type = str,
+                                help = 'output image (default: input name with extension for new order)')
+
+    convert_parser.add_argument('-f', '--force',
+                                action = 'store_true',
+                                help = 'overwrite existing output images')
+
+    convert_parser.add_argument('images',
+                                type = str,
+                                nargs = '*',
+                                help = 'additional images to convert')
+
+    args = parser.parse_args()
+    #print(args)
+
+    if getattr(args, 'multi_image', False):
+        sys.exit(args.cmd_fn(args))
+
+    fmt = image_format(args.image, args.format)
+    if fmt is None:
+        print('must specify image file format', file = sys.stderr)
+        sys.exit(2)
+
+    file_mode = { 'mkfs': 'w',
+                  'ls': 'r',
+                  'x': 'r',
+                  'frag': 'r',
+                  'defrag': 'r' } [args.cmd] + 'b'
+
+    image = open(args.image, file_mode)
+
+    if args.cmd == 'mkfs':
+        disk = SOSDisk(image, fmt, new = True, volume_block_count = args.size)
+    else:
+        disk = SOSDisk(image, fmt)
+
+    status = args.cmd_fn(args, disk)
+
+    disk.close()
+
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
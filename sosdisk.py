@@ -1,9 +1,12 @@
 import datetime
 from enum import Enum, IntEnum, IntFlag
+import heapq
 import math
 import string
 import struct
 import sys
+import threading
+import weakref
 
 def list_to_dict(l):
     return { i: l[i] for i in range(len(l)) }
@@ -15,17 +18,21 @@ def compose_dict(d1, d2):
     return { k: d2[v] for k, v in d1.items() }
 
 
+# Returns a list giving, for each sector of an image in dest_interleave
+# order, the index of the sector of a src_interleave image it comes from.
+def sector_permutation(src_interleave, dest_interleave, track_count = 35):
+    map = compose_dict(dest_interleave, invert_dict(src_interleave))
+    return [t * 16 + map[ds] for t in range(track_count) for ds in range(16)]
+
+def permute_sectors(src_image, permutation, sector_size = 256):
+    src = memoryview(src_image)
+    return bytearray().join([src[s * sector_size:(s + 1) * sector_size] for s in permutation])
+
 def reinterleave(src_image, src_interleave, dest_interleave):
     if src_interleave == dest_interleave:
         return src_image  # not a copy!
-    map = compose_dict(src_interleave, invert_dict(dest_interleave))
-    dest_image = bytearray(len(src_image))
-    for t in range(35):
-        for ss in range(16):
-            src_offset = (t * 16 + ss) * 256
-            dest_offset = (t * 16 + map[ss]) * 256
-            dest_image[dest_offset:dest_offset+256] = src_image[src_offset:src_offset+256]
-    return dest_image
+    track_count = len(src_image) // (16 * 256)
+    return permute_sectors(src_image, sector_permutation(src_interleave, dest_interleave, track_count))
 
 
 half_block_to_phys_sect = list_to_dict([0x00, 0x02, 0x04, 0x06,
@@ -129,6 +136,17 @@ def bytes_to_sos_filename(l, b):
     assert all(c == 0 for c in b[l:])
     return s.lower()
 
+# Returns a list of (first_block, count) for each run of consecutive
+# block numbers in blocks.
+def block_extents(blocks):
+    extents = []
+    for b in blocks:
+        if extents and b == extents[-1][0] + extents[-1][1]:
+            extents[-1] = (extents[-1][0], extents[-1][1] + 1)
+        else:
+            extents.append((b, 1))
+    return extents
+
 def u32_to_sos_timestamp(b):
     if b == 0:
         return None
@@ -159,53 +177,69 @@ class SOSAllocationBitmap:
         print('creating bitmap')
         print(volume_block_count)
         self.bitmap_block_count = math.ceil(volume_block_count / (8 * self.disk.block_size))
-        # mark all blocks as free
+        # mark all blocks, including nonexistent ones past the end of
+        # the volume, as in use
         print(self.bitmap_block_count, self.disk.block_size)
         self.data[:] = bytes(self.bitmap_block_count * self.disk.block_size)
         print(len(self.data))
-        # mark blocks occupied by boot blocks, volume directory, and
-        # volume allocation bitmap as in use
-        self[0:self.start_block+self.bitmap_block_count] = [1] * (self.start_block+self.bitmap_block_count)
-
+        # mark blocks after the boot blocks, volume directory, and
+        # volume allocation bitmap as free
+        first_free = self.start_block + self.bitmap_block_count
+        self[first_free:volume_block_count] = [False] * (volume_block_count - first_free)
+
+    # Indexed by block number, True if the block is in use.  On disk
+    # the bit for block 0 is the most significant bit of the first
+    # byte, and a set bit means the block is free.
     def __getitem__(self, key):
         if isinstance(key, slice):
-            result = [self.__getitem__(i) for i in range(*key.indices(len(self.data)))]
+            return [self.__getitem__(i) for i in range(*key.indices(len(self.data) * 8))]
         else:
-            # XXX is bit numbering little-endian or big-endian?
-            return bool((self.data[key >> 3] >> (key & 7)) & 1)
-
+            return not ((self.data[key >> 3] << (key & 7)) & 0x80)
 
     def __setitem__(self, key, value):
-        print('setitem(', key, ', ', value, ')')
         if isinstance(key, slice):
-            print('slice')
-            print(key.indices(len(self.data)))
-            for k, v in zip(range(*key.indices(len(self.data))), value):
-                print(k, v)
+            for k, v in zip(range(*key.indices(len(self.data) * 8)), value):
                 self.__setitem__(k, v)
-                print(self.data)
         else:
-            # XXX is bit numbering little-endian or big-endian?
             if value:
-                self.data[key >> 3] |= (1 << (key & 7))
+                self.data[key >> 3] &= ~ (0x80 >> (key & 7))
             else:
-                self.data[key >> 3] &= ~ (1 << (key & 7))
+                self.data[key >> 3] |= (0x80 >> (key & 7))
+
+    # Returns a list of (first_block, count) for each run of free
+    # blocks in the volume.
+    def free_runs(self):
+        runs = []
+        in_use = self[0:self.disk.block_count]
+        block = 0
+        while block < len(in_use):
+            if in_use[block]:
+                block += 1
+                continue
+            first = block
+            while block < len(in_use) and not in_use[block]:
+                block += 1
+            runs.append((first, block - first))
+        return runs
 
 
 class SOSStorage:
+    # index_blocks optionally maps block numbers to index block data
+    # that has already been read, e.g. by SOSDisk.walk()
     @staticmethod
-    def create(disk, storage_type, key_pointer):
+    def create(disk, storage_type, key_pointer, index_blocks = None):
         if storage_type == StorageType.seedling:
             return SOSSeedling(disk, key_pointer)
         elif storage_type == StorageType.sapling:
-            return SOSSapling(disk, key_pointer)
+            return SOSSapling(disk, key_pointer, index_blocks)
         elif storage_type == StorageType.tree:
-            return SOSTree(disk, key_pointer)
+            return SOSTree(disk, key_pointer, index_blocks)
 
     def __init__(self, disk, key_pointer):
         self.disk = disk
         self.key_pointer = key_pointer
         self.index = { }
+        self.index_block_numbers = [ ]
         self.index_blocks = 0
         self.data_blocks = 0
         self.last_block_index = 0
@@ -213,21 +247,61 @@ class SOSStorage:
     def is_sparse(self):
         return self.data_blocks != (self.last_block_index + 1)
 
+    def read_index_block(self, block_num, index_blocks):
+        if index_blocks is not None and block_num in index_blocks:
+            return index_blocks[block_num]
+        return self.disk.get_blocks(block_num)
+
+    # Returns a list of (first_block, count) for each run of
+    # consecutive blocks in the order they are read: the index blocks,
+    # then the data blocks in file order.  A file laid out
+    # contiguously has a single extent.
+    def extents(self):
+        blocks = self.index_block_numbers + [self.index[i] for i in sorted(self.index)]
+        return block_extents(blocks)
+
     def get_bytes(self,
              offset = 0,
              length = 0):
         data = bytearray(length)
+        data_offset = 0
         while length > 0:
             block_index = offset // self.disk.block_size
             block_offset = offset % self.disk.block_size
             chunk_length = min(length, self.disk.block_size - block_offset)
             if block_index in self.index:
                 block_number = self.index[block_index]
-                data[offset:offset+chunk_length] = self.disk.get_blocks(block_number)[block_offset:block_offset+chunk_length]
+                data[data_offset:data_offset+chunk_length] = self.disk.get_blocks(block_number)[block_offset:block_offset+chunk_length]
             offset += chunk_length
+            data_offset += chunk_length
             length -= chunk_length
         return data
 
+    # Yields (offset, data) pairs covering the first length bytes of
+    # the file, in order.  Each chunk is a run of blocks that are
+    # consecutive both logically and on the disk, so data is a
+    # memoryview into the image rather than a copy.  Sparse holes are
+    # yielded as zero-filled chunks.
+    def iter_chunks(self, length):
+        block_size = self.disk.block_size
+        block_index = 0
+        while block_index * block_size < length:
+            run_start = block_index
+            if block_index in self.index:
+                first_block = self.index[block_index]
+                block_index += 1
+                while (block_index * block_size < length and
+                       self.index.get(block_index) == first_block + block_index - run_start):
+                    block_index += 1
+                data = self.disk.get_blocks(first_block, block_index - run_start)
+            else:
+                block_index += 1
+                while block_index * block_size < length and block_index not in self.index:
+                    block_index += 1
+                data = bytes((block_index - run_start) * block_size)
+            offset = run_start * block_size
+            yield offset, data[:length - offset]
+
     def __getitem__(self, key):
         if isinstance(key, slice):
             indices = key.indices((self.last_block_index+1) * 512)
@@ -250,9 +324,10 @@ class SOSSeedling(SOSStorage):
         self.data_blocks += 1
 
 class SOSSapling(SOSStorage):
-    def __init__(self, disk, key_pointer):
+    def __init__(self, disk, key_pointer, index_blocks = None):
         super().__init__(disk, key_pointer)
-        index_data = self.disk.get_blocks(key_pointer)
+        index_data = self.read_index_block(key_pointer, index_blocks)
+        self.index_block_numbers.append(key_pointer)
         self.index_blocks += 1
         for j in range(256):
             b = index_data[j] + (index_data[j + 256] << 8)
@@ -262,27 +337,36 @@ class SOSSapling(SOSStorage):
                 self.last_block_index = j
 
 class SOSTree(SOSStorage):
-    def __init__(self, disk, key_pointer):
+    def __init__(self, disk, key_pointer, index_blocks = None):
         super().__init__(disk, key_pointer)
-        top_index_data = self.disk.get_blocks(key_pointer)
+        top_index_data = self.read_index_block(key_pointer, index_blocks)
+        self.index_block_numbers.append(key_pointer)
         self.index_blocks += 1
         for i in range(256):
             tb = top_index_data[i] + (top_index_data[i + 256] << 8)
             if tb != 0:
-                index_data = self.disk.get_blocks(b)
+                index_data = self.read_index_block(tb, index_blocks)
+                self.index_block_numbers.append(tb)
                 self.index_blocks += 1
                 for j in range(256):
                     b = index_data[j] + (index_data[j + 256] << 8)
                     if b != 0:
-                        self.index[j * 256 + i] = b
+                        self.index[i * 256 + j] = b
                         self.data_blocks += 1
-                        self.last_block_index = j
+                        self.last_block_index = i * 256 + j
 
 class SOSDirectoryEntry:
     entry_size = 39
 
     def __init__(self, disk):
         self.disk = disk
+        self.generation = disk.generation
+
+    # defragment() moves every block, so entries read before it would
+    # find the wrong data at their old block numbers.
+    def check_current(self):
+        if self.generation != self.disk.generation:
+            raise RuntimeError('%s: stale entry, the disk has been defragmented' % self.name)
 
     @staticmethod
     def create_from_data(disk, entry_data, block_num, first_dir_entry):
@@ -344,17 +428,38 @@ class SOSFileEntry(SOSDirectoryEntry):
         self.storage_type = StorageType(storage_nl >> 4)
         if self.storage_type == StorageType.unused_entry:
             return
-        self.pos = 0
         self.eof = eof [2] << 16 | eof [1] << 8 | eof[0]
         self._name = bytes_to_sos_filename(name_length, name_b)
         self._creation = u32_to_sos_timestamp(creation_b)
         if self.storage_type == StorageType.subdirectory:
             assert self.file_type == FileType.dir
-            self.subdir = SOSDirectory(disk, self.key_pointer)
         else:
             assert self.storage_type in set([StorageType.seedling, StorageType.sapling, StorageType.tree])
             assert self.file_type != FileType.dir
-            self.storage = SOSStorage.create(self.disk, self.storage_type, self.key_pointer)
+        # subdirectory and index blocks are read on first use
+        self._subdir = None
+        self._storage = None
+
+    # Entries may be shared between threads, so the lazily parsed
+    # subdirectory and storage are built under the disk's lock.  Once
+    # built they are never modified.
+    @property
+    def subdir(self):
+        self.check_current()
+        if self._subdir is None:
+            with self.disk.lock:
+                if self._subdir is None:
+                    self._subdir = SOSDirectory(self.disk, self.key_pointer)
+        return self._subdir
+
+    @property
+    def storage(self):
+        self.check_current()
+        if self._storage is None:
+            with self.disk.lock:
+                if self._storage is None:
+                    self._storage = SOSStorage.create(self.disk, self.storage_type, self.key_pointer)
+        return self._storage
 
     @property
     def name(self):
@@ -370,22 +475,11 @@ class SOSFileEntry(SOSDirectoryEntry):
     def __getitem__(self, key):
         return self.storage.__getitem__(key)
 
-    def seek(self, offset, from_what = 0):
-        if from_what == 0:
-            self.pos = offset
-        elif from_what == 1:
-            self.pos += offset
-        elif from_what == 2:
-            self.pos = self.eof + offset
-        else:
-            assert False
-
-    def read(self, length = None):
-        if length is None:
-            length = self.eof - self.pos
-        data = self.storage[self.pos:self.pos+length]
-        self.pos += len(data)
-        return data
+    # Returns a new handle with its own read position, so any number
+    # of threads can read the same file at once.
+    def open(self):
+        assert self.storage_type != StorageType.subdirectory
+        return SOSFileHandle(self)
 
 
     def print(self,
@@ -400,9 +494,9 @@ class SOSFileEntry(SOSDirectoryEntry):
             attr = self.access
             attrs = ''
             if self.storage_type != StorageType.subdirectory and self.storage.is_sparse():
-                self.access |= FileAttributes.sparse
+                attr |= FileAttributes.sparse
             for b in range(8, -1, -1):
-                if self.access & (1 << b):
+                if attr & (1 << b):
                     attrs += attrchar[b]
                 else:
                     attrs += '.'
@@ -419,6 +513,59 @@ class SOSFileEntry(SOSDirectoryEntry):
                               file = file)
         
 
+class SOSFileHandle:
+    # Registered under the disk's lock, so defragment() either sees
+    # the handle and refuses, or finishes first and the entry is stale.
+    def __init__(self, entry):
+        self.entry = entry
+        self.pos = 0
+        with entry.disk.lock:
+            self.storage = entry.storage
+            entry.disk.open_handles.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.entry.disk.open_handles.discard(self)
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, from_what = 0):
+        if from_what == 0:
+            pos = offset
+        elif from_what == 1:
+            pos = self.pos + offset
+        elif from_what == 2:
+            pos = self.entry.eof + offset
+        else:
+            assert False
+        if pos < 0:
+            raise ValueError('negative seek position %d' % pos)
+        self.pos = pos
+        return self.pos
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    # A length of None or less than zero reads to the end of the file,
+    # as with io.RawIOBase.read().
+    def read(self, length = None):
+        self.entry.check_current()
+        if length is None or length < 0 or length > self.entry.eof - self.pos:
+            length = max(0, self.entry.eof - self.pos)
+        data = self.storage[self.pos:self.pos+length]
+        self.pos += len(data)
+        return data
+
+
 class SOSDirectoryBlock:
     first_entry_offset = 4
 
@@ -429,14 +576,16 @@ class SOSDirectoryBlock:
                  first_dir_block = False,
                  new = False,
                  directory_name = None,   # if new
-                 prev_block_num = None):      # if new
+                 prev_block_num = None,   # if new
+                 data = None):            # block data, if already read
         self.disk = disk
         self.directory = directory
+        self.block_num = block_num
         self.entries = []
         if new:
             self.__create_new(block_num, first_dir_block)
         else:
-            self.__read_from_image(block_num, first_dir_block)
+            self.__read_from_image(block_num, first_dir_block, data)
 
     @property
     def prev_block(self):
@@ -457,8 +606,8 @@ class SOSDirectoryBlock:
     def __getitem__(self, key):
         return self.entries[key]
 
-    def __read_from_image(self, block_num, first_dir_block = False):
-        self.data = self.disk.get_blocks(block_num)
+    def __read_from_image(self, block_num, first_dir_block = False, data = None):
+        self.data = data if data is not None else self.disk.get_blocks(block_num)
 
         #print('prev: %d, next: %d' % (self.prev_block, self.next_block))
         for i in range(self.directory.entries_per_block):
@@ -484,12 +633,15 @@ class SOSDirectory:
                  first_block = None,
                  new = False,
                  block_count = 1,         # if new
-                 directory_name = None):  # if new
+                 directory_name = None,   # if new
+                 walked = False):         # blocks supplied by add_block()
         self.disk = disk
         self.growable = first_block != 2
         self.entries_per_block = (self.disk.block_size - SOSDirectoryBlock.first_entry_offset) // SOSDirectoryEntry.entry_size
         if new:
             self.__create_new(first_block, block_count)
+        elif walked:
+            self.directory_blocks = []
         else:
             # block_count not used
             self.__read_from_image(first_block)
@@ -505,6 +657,19 @@ class SOSDirectory:
                                                            self.directory_blocks[-1].next_block))
         self.header = self.directory_blocks[0].entries[0]
 
+    # Appends the next block of the directory's chain from data that
+    # has already been read, and returns it.
+    def add_block(self, block_num, data):
+        db = SOSDirectoryBlock(self.disk,
+                               self,
+                               block_num,
+                               first_dir_block = not self.directory_blocks,
+                               data = data)
+        self.directory_blocks.append(db)
+        if len(self.directory_blocks) == 1:
+            self.header = db.entries[0]
+        return db
+
     def __create_new(self, first_block = None, block_count = 1):
         prev_block_num = 0
         self.directory_blocks = []
@@ -527,13 +692,33 @@ class SOSDirectory:
         entry_within_block = key % self.entries_per_block
         return self.directory_blocks[rel_dir_block][entry_within_block]
 
+    # Yields (pathname, entry) for each file in the directory, with
+    # path prepended to the name.  Subdirectory entries themselves are
+    # not yielded, but their contents are if recursive is set.
     def files(self,
               path,
               recursive = False):
         for db in self.directory_blocks:
             for entry in db.entries:
-                if isinstance(entry, SOSFileEntry) and (entry.storage_type != StorageType.unused_entry) and hasattr(entry, 'storage'):
-                    yield entry
+                if not isinstance(entry, SOSFileEntry) or entry.storage_type == StorageType.unused_entry:
+                    continue
+                if entry.storage_type == StorageType.subdirectory:
+                    if recursive:
+                        yield from entry.subdir.files(path + entry.name + '/', recursive)
+                else:
+                    yield path + entry.name, entry
+
+    def extents(self):
+        return block_extents([db.block_num for db in self.directory_blocks])
+
+    def lookup(self, name):
+        for db in self.directory_blocks:
+            for entry in db.entries:
+                if (isinstance(entry, SOSFileEntry) and
+                    entry.storage_type != StorageType.unused_entry and
+                    entry.name == name):
+                    return entry
+        return None
 
     def print(self, prefix,
               recursive = False,
@@ -556,6 +741,15 @@ class SOSDisk:
         self.image_file = f
         self.image_file_fmt = fmt
         self.block_size = 512
+        # Guards lazy parsing of the directory tree, and defragment().
+        # Apart from defragment(), which refuses to run while any
+        # SOSFileHandle is open, the image data isn't modified after it
+        # is read, and get_blocks() only hands out views of it, so
+        # reads need no locking.
+        self.lock = threading.RLock()
+        self.open_handles = weakref.WeakSet()
+        # bumped by defragment(), see SOSDirectoryEntry.check_current()
+        self.generation = 0
         if new:
             self.__create_new(volume_block_count, volume_directory_block_count)
         else:
@@ -573,8 +767,11 @@ class SOSDisk:
                 print('Images other than 16-sector floppy must be in SOS/ProDOS sector order', file = sys.stderr)
                 sys.exit(2)
             self.data = reinterleave(self.data, interleave_tables[self.image_file_fmt], interleave_tables['po'])
+        self.__read_volume()
+
+    def __read_volume(self):
         self.volume_directory = SOSDirectory(self, 2, new = False)
-        self.bitmap_block_count = (self.volume_directory.header.total_blocks + 1) // (self.block_size * 8)
+        self.bitmap_block_count = math.ceil(self.volume_directory.header.total_blocks / (self.block_size * 8))
         self.bitmap_start_block = self.volume_directory.header.bitmap_pointer
         self.allocation_bitmap = SOSAllocationBitmap(self, self.bitmap_start_block, self.bitmap_block_count)
 
@@ -583,20 +780,183 @@ class SOSDisk:
         self.dirty = True
         self.block_count = volume_block_count;
         self.data = bytearray(self.block_count * self.block_size)
-        self.bitmap_block_count = (volume_block_count + 1) // (self.block_size * 8)
+        self.bitmap_block_count = math.ceil(volume_block_count / (self.block_size * 8))
         self.bitmap_start_block = 2 + volume_directory_block_count
         self.allocation_bitmap = SOSAllocationBitmap(self, self.bitmap_start_block, self.bitmap_block_count, create = True, volume_block_count = self.block_count)
         self.volume_directory = SOSDirectory(self, 2, new = True, block_count = volume_directory_block_count)
 
 
+    # Writes the image, in its original sector order, to f.
+    def write(self, f):
+        f.write(reinterleave(self.data, interleave_tables['po'], interleave_tables[self.image_file_fmt]))
+
     def close(self):
         if self.dirty:
             print('dirty')
             self.image_file.seek(0)
-            self.image_file.write(reinterleave(self.data, interleave_tables['po'], interleave_tables[self.image_file_fmt]))
+            self.write(self.image_file)
         self.data = None
         self.image_file.close()
 
+    # Rewrites the volume so that the volume directory and bitmap are
+    # followed by each directory and file in directory order, depth
+    # first, every one in a single contiguous run: a directory's
+    # blocks, or a file's index blocks followed by its data blocks.
+    # Key pointers, index blocks, directory block links, header and
+    # parent pointers and the bitmap are all rebuilt; everything after
+    # the last used block is zeroed.  Sparse files stay sparse, but
+    # empty second-level index blocks of tree files are dropped.
+    # Files of type bad exist to keep bad blocks allocated, so they
+    # stay where they are and everything else is packed around them.
+    # Blocks marked in use that no directory or file owns are kept in
+    # place the same way, unless free_unowned is set, in which case
+    # they are freed and zeroed.  Returns the sorted list of those
+    # unowned block numbers.
+    #
+    # The new image is built aside and swapped in under the lock, and
+    # the volume directory is parsed again.  Entries, storage and
+    # directories obtained before the call still refer to the old
+    # block numbers; they raise RuntimeError if used afterwards, as
+    # does defragment() itself if any file handle is still open.
+    def defragment(self, free_unowned = False):
+        with self.lock:
+            if self.open_handles:
+                raise RuntimeError('cannot defragment with %d open file handle(s)' % len(self.open_handles))
+            return self.__defragment(free_unowned)
+
+    # Returns the set of blocks used by the boot blocks, the bitmap and
+    # the directory tree, including the index and data blocks of every
+    # file.
+    def __owned_blocks(self):
+        owned = set([0, 1])
+        owned.update(range(self.bitmap_start_block, self.bitmap_start_block + self.bitmap_block_count))
+        directories = [self.volume_directory]
+        while directories:
+            directory = directories.pop()
+            owned.update(db.block_num for db in directory.directory_blocks)
+            for db in directory.directory_blocks:
+                for entry in db.entries:
+                    if not isinstance(entry, SOSFileEntry) or entry.storage_type == StorageType.unused_entry:
+                        continue
+                    if entry.storage_type == StorageType.subdirectory:
+                        directories.append(entry.subdir)
+                    else:
+                        owned.update(entry.storage.index_block_numbers)
+                        owned.update(entry.storage.index.values())
+        return owned
+
+    def __defragment(self, free_unowned):
+        bs = self.block_size
+        new_data = bytearray(len(self.data))
+        new_data[0:2*bs] = self.get_blocks(0, 2)
+        in_use = [False] * self.block_count
+        in_use[0:2] = [True, True]
+        next_block = 2
+
+        # returns the first of count free blocks in a row, starting
+        # the search after the last block allocated
+        def alloc(count):
+            nonlocal next_block
+            first = next_block
+            while any(in_use[first:first+count]):
+                first += 1
+            assert first + count <= self.block_count
+            in_use[first:first+count] = [True] * count
+            next_block = first + count
+            return first
+
+        def copy_block(old, new):
+            new_data[new*bs:(new+1)*bs] = self.get_blocks(old)
+
+        def bad_block_files(directory):
+            for path, entry in directory.files('', recursive = True):
+                if entry.file_type == FileType.bad:
+                    yield entry
+
+        owned = self.__owned_blocks()
+        unowned = [b for b in range(self.block_count) if self.allocation_bitmap[b] and b not in owned]
+        if not free_unowned:
+            for b in unowned:
+                in_use[b] = True
+                copy_block(b, b)
+
+        # reserve the blocks of bad files, and copy them in place
+        for entry in bad_block_files(self.volume_directory):
+            for b in entry.storage.index_block_numbers + list(entry.storage.index.values()):
+                in_use[b] = True
+                copy_block(b, b)
+
+        def set_pointer(block, index, pointer):
+            new_data[block*bs + index] = pointer & 0xff
+            new_data[block*bs + index + 256] = pointer >> 8
+
+        # returns the new key pointer and block count
+        def relocate_storage(storage):
+            data_blocks = sorted(storage.index.items())
+            if isinstance(storage, SOSSeedling):
+                key = alloc(1)
+                copy_block(storage.key_pointer, key)
+                return key, 1
+            # the key block, any second-level index blocks and the
+            # data blocks are allocated as a single run
+            if isinstance(storage, SOSSapling):
+                groups = []
+            else:
+                groups = sorted(set(i // 256 for i, b in data_blocks))
+            index_block_count = 1 + len(groups)
+            key = alloc(index_block_count + len(data_blocks))
+            # index blocks by the group of 256 data blocks they cover
+            if isinstance(storage, SOSSapling):
+                index_blocks = { 0: key }
+            else:
+                index_blocks = { }
+                for k, g in enumerate(groups):
+                    index_blocks[g] = key + 1 + k
+                    set_pointer(key, g, key + 1 + k)
+            first_data = key + index_block_count
+            for k, (i, b) in enumerate(data_blocks):
+                copy_block(b, first_data + k)
+                set_pointer(index_blocks[i // 256], i % 256, first_data + k)
+            return key, index_block_count + len(data_blocks)
+
+        def relocate_directory(directory, first_block, parent_block):
+            new_blocks = [first_block + i for i in range(len(directory.directory_blocks))]
+            for i, db in enumerate(directory.directory_blocks):
+                block = new_blocks[i]
+                copy_block(db.block_num, block)
+                struct.pack_into('<HH', new_data, block*bs,
+                                 new_blocks[i-1] if i > 0 else 0,
+                                 new_blocks[i+1] if i < len(new_blocks) - 1 else 0)
+                for j, entry in enumerate(db.entries):
+                    offset = block*bs + SOSDirectoryBlock.first_entry_offset + j * SOSDirectoryEntry.entry_size
+                    if isinstance(entry, SOSVolumeDirectoryHeader):
+                        struct.pack_into('<H', new_data, offset + 35, bitmap_start_block)
+                    elif isinstance(entry, SOSSubdirectoryHeader):
+                        struct.pack_into('<H', new_data, offset + 35, parent_block)
+                    elif entry.storage_type == StorageType.subdirectory:
+                        subdir_block = alloc(len(entry.subdir.directory_blocks))
+                        struct.pack_into('<H', new_data, offset + 17, subdir_block)
+                        struct.pack_into('<H', new_data, offset + 37, new_blocks[0])
+                        relocate_directory(entry.subdir, subdir_block, block)
+                    elif entry.file_type == FileType.bad and entry.storage_type != StorageType.unused_entry:
+                        struct.pack_into('<H', new_data, offset + 37, new_blocks[0])
+                    elif entry.storage_type != StorageType.unused_entry:
+                        key, blocks_used = relocate_storage(entry.storage)
+                        struct.pack_into('<HH', new_data, offset + 17, key, blocks_used)
+                        struct.pack_into('<H', new_data, offset + 37, new_blocks[0])
+
+        volume_directory_block = alloc(len(self.volume_directory.directory_blocks))
+        assert volume_directory_block == 2
+        bitmap_start_block = alloc(self.bitmap_block_count)
+        relocate_directory(self.volume_directory, volume_directory_block, 0)
+
+        self.generation += 1
+        self.data = new_data
+        self.dirty = True
+        self.__read_volume()
+        self.allocation_bitmap[0:self.block_count] = in_use
+        return unowned
+
     def get_blocks(self, first_block, count = 1):
         offset = first_block * 512
         length = count * 512
@@ -607,10 +967,149 @@ class SOSDisk:
               recursive = True):
         return self.volume_directory.files(path, recursive)
 
+    def lookup(self, path):
+        directory = self.volume_directory
+        entry = None
+        for name in path.lower().strip('/').split('/'):
+            if directory is None:
+                raise FileNotFoundError(path)
+            entry = directory.lookup(name)
+            if entry is None:
+                raise FileNotFoundError(path)
+            directory = entry.subdir if entry.storage_type == StorageType.subdirectory else None
+        if entry is None:
+            raise FileNotFoundError(path)
+        return entry
+
+    def open(self, path):
+        entry = self.lookup(path)
+        if entry.storage_type == StorageType.subdirectory:
+            raise IsADirectoryError(path)
+        return entry.open()
+
+    # Yields (pathname, entry) for every file and subdirectory, in the
+    # order their blocks are found on the disk rather than directory
+    # order.  Pending directory and index blocks are kept in a queue
+    # sorted by block number and read in ascending, coalesced runs,
+    # wrapping around to the lowest block when the end is reached, so
+    # a cold or seek-bound image is read close to sequentially.
+    #
+    # The blocks read are kept rather than read again later: a sapling
+    # or tree file is yielded once all of its index blocks have
+    # arrived, with its storage built from them.  A subdirectory is
+    # yielded when its first block arrives, before any of its
+    # children, but its subdir is only attached once its whole chain
+    # has arrived; accessing .subdir before the walk finishes may read
+    # the directory again.  Seedling files are yielded as soon as
+    # their directory block arrives.  Directories and storage that
+    # were already parsed, such as the volume directory, are not read
+    # again.
+    def walk(self,
+             path = '',
+             recursive = True):
+        tasks = { }      # block number -> list of tasks waiting for it
+        ahead = []       # heap of pending block numbers after the head
+        behind = []      # heap of pending block numbers at or before the head
+        head = 0
+
+        def schedule(block_num, task):
+            if block_num not in tasks:
+                tasks[block_num] = []
+                heapq.heappush(ahead if block_num > head else behind, block_num)
+            tasks[block_num].append(task)
+
+        def index_pointers(data):
+            for i in range(256):
+                b = data[i] + (data[i + 256] << 8)
+                if b != 0:
+                    yield b
+
+        # Yields the entries of a parsed directory block that are ready,
+        # and schedules the blocks needed by the rest.
+        def visit_block(db, dir_path):
+            for entry in db.entries:
+                if not isinstance(entry, SOSFileEntry) or entry.storage_type == StorageType.unused_entry:
+                    continue
+                entry_path = dir_path + entry.name
+                if entry.storage_type == StorageType.subdirectory:
+                    if not recursive:
+                        yield entry_path, entry
+                    elif entry._subdir is not None:
+                        yield entry_path, entry
+                        yield from visit_directory(entry._subdir, entry_path + '/')
+                    else:
+                        schedule(entry.key_pointer,
+                                 ('dir', entry_path + '/', entry, SOSDirectory(self, entry.key_pointer, walked = True)))
+                elif entry.storage_type == StorageType.seedling or entry._storage is not None:
+                    yield entry_path, entry
+                else:
+                    schedule(entry.key_pointer, ('index', entry_path, entry, [1], { }, True))
+
+        def visit_directory(directory, dir_path):
+            for db in directory.directory_blocks:
+                yield from visit_block(db, dir_path)
+
+        # directory task:  ('dir', path, entry, directory)
+        #   directory is being built from its blocks as they arrive,
+        #   and is attached to entry once the chain is complete
+        # index task:      ('index', path, entry, waiting, blocks, top_level)
+        #   waiting is a one-element list shared by all of a file's
+        #   index tasks, counting the index blocks not yet arrived,
+        #   and blocks collects the data of those that have
+        yield from visit_directory(self.volume_directory, path)
+        while ahead or behind:
+            if not ahead:
+                ahead, behind = behind, ahead
+            first = heapq.heappop(ahead)
+            count = 1
+            while ahead and ahead[0] == first + count:
+                heapq.heappop(ahead)
+                count += 1
+            head = first + count - 1
+            run = self.get_blocks(first, count)
+            for i in range(count):
+                block_num = first + i
+                data = run[i * self.block_size:(i + 1) * self.block_size]
+                for task in tasks.pop(block_num):
+                    if task[0] == 'dir':
+                        dir_path, entry, directory = task[1:]
+                        db = directory.add_block(block_num, data)
+                        if db.next_block != 0:
+                            schedule(db.next_block, task)
+                        else:
+                            with self.lock:
+                                if entry._subdir is None:
+                                    entry._subdir = directory
+                        if len(directory.directory_blocks) == 1:
+                            yield dir_path[:-1], entry
+                        yield from visit_block(db, dir_path)
+                    else:
+                        entry_path, entry, waiting, blocks, top_level = task[1:]
+                        blocks[block_num] = data
+                        if top_level and entry.storage_type == StorageType.tree:
+                            for b in index_pointers(data):
+                                waiting[0] += 1
+                                schedule(b, ('index', entry_path, entry, waiting, blocks, False))
+                        waiting[0] -= 1
+                        if waiting[0] == 0:
+                            with self.lock:
+                                if entry._storage is None:
+                                    entry._storage = SOSStorage.create(self, entry.storage_type, entry.key_pointer, blocks)
+                            yield entry_path, entry
+
+    # Reads and attaches the directory tree and file index blocks in
+    # block order with walk(), so that a following traversal in
+    # directory order finds them already parsed.
+    def prefetch(self, recursive = True):
+        for path, entry in self.walk(recursive = recursive):
+            pass
+
     def print_directory(self,
                         recursive = False,
                         long = False,
                         file = sys.stdout):
+        if recursive or long:
+            self.prefetch(recursive = recursive)
         print('volume /%s:' % self.volume_directory.header.name)
         self.volume_directory.print('',
                                     #prefix = '/' + self.volume_directory.header.name,